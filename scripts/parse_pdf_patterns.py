@@ -1,13 +1,23 @@
 #!/usr/bin/env -S uv run
 # /// script
 # requires-python = ">=3.11"
-# dependencies = ["google-genai", "jinja2", "pydantic"]
+# dependencies = [
+#     "google-genai",
+#     "httpx",
+#     "jinja2",
+#     "orjson",
+#     "Pillow",
+#     "pydantic",
+#     "pypdfium2",
+# ]
 # ///
 """Extract drum patterns from PDF using Gemini Vision API.
 
 Subcommands:
-  extract  Render PDF pages to PNG images
-  parse    Send images to Gemini for cell-by-cell extraction
+  extract  Render PDF pages to PNG images (optional; parse
+           renders any page it is missing)
+  parse    Send images to Gemini for cell-by-cell extraction,
+           rendering missing pages from the PDF first
   verify   Generate HTML report for human review
   merge    Merge verified patterns into patterns.json
 
@@ -19,27 +29,38 @@ Usage:
 
 Requires:
   GEMINI_API_KEY environment variable
-  pdftoppm (poppler-utils: apt install poppler-utils)
 """
 
 import argparse
+import contextlib
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
 import re
-import shutil
-import subprocess
 import sys
-import tempfile
+import threading
 import time
+from collections import deque
+from concurrent.futures import (
+  Future,
+  ProcessPoolExecutor,
+  ThreadPoolExecutor,
+)
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import Any, Self
 
+import httpx
+import pypdfium2 as pdfium
+from google import genai
+from google.genai import errors, types
+from PIL import Image
 from pydantic import BaseModel, Field
 
-if TYPE_CHECKING:
-  from google import genai
-
 logger = logging.getLogger(__name__)
 
 SCRIPT_DIR = Path(__file__).parent
@@ -48,6 +69,7 @@ OUTPUT_DIR = SCRIPT_DIR / "parsed_patterns"
 IMAGES_DIR = OUTPUT_DIR / "images"
 PASSES_DIR = OUTPUT_DIR / "passes"
 CONSENSUS_DIR = OUTPUT_DIR / "consensus"
+RENDER_CACHE_DIR = OUTPUT_DIR / "render_cache"
 PATTERNS_JSON = (
   PROJECT_ROOT / "src" / "app" / "data" / "patterns.json"
 )
@@ -56,6 +78,26 @@ DEFAULT_PDF = PROJECT_ROOT / "260_drum_machine_patterns_1987.pdf"
 DEFAULT_PAGE_START = 9
 DEFAULT_PAGE_END = 97
 DEFAULT_PASSES = 3
+RENDER_DPI = 300
+DEFAULT_UPLOAD_DPI = 200
+DEFAULT_UPLOAD_FORMAT = "jpeg"
+JPEG_QUALITY = 85
+UPLOAD_MIME_TYPES = {"jpeg": "image/jpeg", "png": "image/png"}
+GRID_MIN_LINES = 12
+GRID_LINE_MIN_FRACTION = 0.25
+GRID_SPACING_TOLERANCE = 0.25
+# Each spawned worker re-imports this module (google-genai,
+# httpx, pypdfium2), so keep the pool small; one check takes
+# milliseconds and the producer only needs a few in flight.
+PREFILTER_WORKERS = min(4, os.cpu_count() or 1)
+PREFILTER_WINDOW = 2 * PREFILTER_WORKERS
+DEFAULT_CONCURRENCY = 8
+DEFAULT_BATCH_SIZE = 4
+MIN_REQUEST_INTERVAL = 1.0
+REQUEST_TIMEOUT_MS = 300_000
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 60.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 MODEL = "gemini-3.1-pro-preview"
 
 ALL_TRACK_IDS = [
@@ -74,6 +116,13 @@ INSTRUMENT_ORDER = [
   "SD", "RS", "LT", "CPS", "CB", "BD",
 ]
 
+# Name and step-string patterns, compiled once at import.
+_COLON_RE = re.compile(r":\s*")
+_NONALNUM_RE = re.compile(r"[^a-z0-9\-]")
+_MULTIHYPHEN_RE = re.compile(r"-+")
+_WS_RE = re.compile(r"\s+")
+_STEP_RE = re.compile(r"[01]{16}")
+
 
 class Cell(BaseModel):
   """A single cell in the pattern grid."""
@@ -120,6 +169,37 @@ class PageResponse(BaseModel):
   )
 
 
+class PageResult(BaseModel):
+  """Pattern grids for one page of a batched request."""
+
+  page_index: int = Field(
+    description="Number from the page's PAGE_N label, 1-indexed"
+  )
+  patterns: list[PatternGrid] = Field(
+    description="Pattern grids found on this page"
+  )
+
+
+class PagedResponse(BaseModel):
+  """Per-page results for a batch of page images."""
+
+  pages: list[PageResult] = Field(
+    description="One entry per page image, in label order"
+  )
+
+
+# (page_num, image_data, mime_type) for one page ready to upload.
+PageImage = tuple[int, bytes, str]
+
+BATCH_PROMPT = """\
+You will receive {count} drum machine pattern pages as images,
+each preceded by a text label PAGE_1 to PAGE_{count}. Apply the
+extraction instructions to each page independently. Return one
+entry per page in "pages", with page_index set to the number
+from its label and patterns holding only the grids from that
+page.
+"""
+
 EXTRACTION_PROMPT = """\
 Analyze this drum machine pattern page. It may contain zero
 or more drum pattern grids and musical notation. Ignore the
@@ -300,42 +380,307 @@ REPORT_TEMPLATE = """\
 """
 
 
+class RateLimiter:
+  """Caps in-flight Gemini requests and spaces out their starts.
+
+  The semaphore bounds how many requests run at once; the
+  monotonic timestamp enforces a minimum interval between
+  request starts across all threads.
+  """
+
+  def __init__(
+    self,
+    max_concurrent: int,
+    min_interval: float = MIN_REQUEST_INTERVAL,
+  ) -> None:
+    self._semaphore = threading.Semaphore(max_concurrent)
+    self._lock = threading.Lock()
+    self._min_interval = min_interval
+    self._next_start = 0.0
+
+  def __enter__(self) -> Self:
+    self._semaphore.acquire()
+    with self._lock:
+      now = time.monotonic()
+      start = max(now, self._next_start)
+      self._next_start = start + self._min_interval
+    if start > now:
+      time.sleep(start - now)
+    return self
+
+  def __exit__(self, *exc: object) -> None:
+    self._semaphore.release()
+
+
+def encode_for_upload(
+  image_data: bytes,
+  dpi: int = DEFAULT_UPLOAD_DPI,
+  fmt: str = DEFAULT_UPLOAD_FORMAT,
+) -> tuple[bytes, str]:
+  """Downscale and re-encode a rendered page for upload.
+
+  Smaller payloads upload faster. They do not cost fewer
+  tokens: Gemini bills each image at a fixed budget set by
+  media_resolution in generate_with_retry. The on-disk images
+  stay at RENDER_DPI for the report and the CV pipeline.
+
+  Args:
+    image_data: PNG bytes rendered at RENDER_DPI.
+    dpi: Target resolution for the upload.
+    fmt: Output format, 'jpeg' or 'png'.
+
+  Returns:
+    Tuple of (encoded bytes, MIME type).
+  """
+  mime_type = UPLOAD_MIME_TYPES[fmt]
+  if dpi >= RENDER_DPI and fmt == "png":
+    return image_data, mime_type
+
+  img = Image.open(io.BytesIO(image_data))
+  if dpi < RENDER_DPI:
+    scale = dpi / RENDER_DPI
+    img = img.resize(
+      (round(img.width * scale), round(img.height * scale)),
+      Image.Resampling.LANCZOS,
+    )
+  buf = io.BytesIO()
+  if fmt == "jpeg":
+    if img.mode not in ("RGB", "L"):
+      img = img.convert("RGB")
+    img.save(buf, "JPEG", quality=JPEG_QUALITY)
+  else:
+    img.save(buf, "PNG", optimize=False)
+  return buf.getvalue(), mime_type
+
+
+def looks_like_grid_page(image: bytes | Path) -> bool:
+  """Cheap local check for whether a page may contain a grid.
+
+  Finds thin horizontal rules (rows that are mostly dark across
+  the page) and looks for a run of GRID_MIN_LINES of them with
+  roughly even spacing, like the lines between instrument rows.
+  A gap of two or three spacings still counts, since a fully
+  filled row merges its border lines into one thick band.
+  Text-only pages have no such rules. Thin rules fade out when
+  a page is downscaled, so pass the RENDER_DPI image rather than
+  the upload copy.
+
+  Args:
+    image: Encoded page image (any format Pillow reads), or the
+      path to one.
+
+  Returns:
+    True if the page may contain a pattern grid.
+  """
+  if isinstance(image, bytes):
+    image = io.BytesIO(image)
+  img = Image.open(image).convert("L")
+  dark = img.point(lambda p: 255 if p < 128 else 0)
+  # Per-row dark fraction, computed by Pillow in C.
+  profile = dark.resize(
+    (1, dark.height), Image.Resampling.BOX
+  ).tobytes()
+
+  max_thickness = max(3, dark.height // 150)
+  min_dark = GRID_LINE_MIN_FRACTION * 255
+  centers: list[float] = []
+  run_start = None
+  for y, value in enumerate([*profile, 0]):
+    if value >= min_dark:
+      if run_start is None:
+        run_start = y
+    elif run_start is not None:
+      if y - run_start <= max_thickness:
+        centers.append((run_start + y - 1) / 2)
+      run_start = None
+
+  for i in range(len(centers) - 1):
+    spacing = centers[i + 1] - centers[i]
+    lines = 2
+    for j in range(i + 2, len(centers)):
+      gap = centers[j] - centers[j - 1]
+      steps = round(gap / spacing)
+      if (
+        steps not in (1, 2, 3)
+        or abs(gap - steps * spacing)
+        > GRID_SPACING_TOLERANCE * spacing
+      ):
+        break
+      lines += steps
+    if lines >= GRID_MIN_LINES:
+      return True
+  return False
+
+
+def is_retryable(error: Exception) -> bool:
+  """Whether a failed Gemini call is worth retrying.
+
+  Args:
+    error: Exception raised by the API call.
+
+  Returns:
+    True for rate limits, 5xx responses, and network errors.
+  """
+  if isinstance(error, errors.APIError):
+    return error.code in RETRYABLE_STATUS_CODES
+  return True
+
+
+def generate_with_retry(
+  client: genai.Client,
+  model: str,
+  contents: list[Any],
+  schema: type[BaseModel],
+  limiter: RateLimiter | None,
+  label: str,
+) -> Any:
+  """Call Gemini with structured output, retrying on failure.
+
+  EXTRACTION_PROMPT goes in the system instruction, so contents
+  only carry the page images and any per-request text. Transient
+  failures (see is_retryable) are retried up to MAX_ATTEMPTS
+  times with jittered exponential backoff.
+
+  Args:
+    client: Gemini API client.
+    model: Gemini model name.
+    contents: Request contents (image parts and labels).
+    schema: Pydantic model for the response.
+    limiter: Optional rate limiter wrapping the API call.
+    label: Description of the request for retry logging.
+
+  Returns:
+    The parsed response, an instance of schema.
+  """
+  attempt = 0
+  while True:
+    try:
+      with limiter or contextlib.nullcontext():
+        response = client.models.generate_content(
+          model=model,
+          contents=contents,
+          config=types.GenerateContentConfig(
+            system_instruction=EXTRACTION_PROMPT,
+            response_mime_type="application/json",
+            response_schema=schema,
+            thinking_config=types.ThinkingConfig(
+              thinking_level="high",
+            ),
+            media_resolution="MEDIA_RESOLUTION_HIGH",
+          ),
+        )
+      return response.parsed
+    except (
+      errors.APIError, httpx.TransportError, TimeoutError
+    ) as e:
+      attempt += 1
+      if attempt >= MAX_ATTEMPTS or not is_retryable(e):
+        raise
+      delay = min(MAX_BACKOFF, 2 ** (attempt - 1) + random.random())
+      logger.warning(
+        "%s: attempt %d/%d failed (%s), retrying in %.1fs",
+        label, attempt, MAX_ATTEMPTS, e, delay,
+      )
+      time.sleep(delay)
+
+
 def send_to_gemini(
-  client: "genai.Client",
-  image_path: Path,
+  client: genai.Client,
+  image_data: bytes,
   model: str,
+  limiter: RateLimiter | None = None,
+  mime_type: str = "image/png",
+  page_num: int | None = None,
 ) -> list[PatternGrid]:
   """Send a page image to Gemini and get structured output.
 
   Args:
     client: Gemini API client.
-    image_path: Path to the PNG image.
+    image_data: Encoded page image bytes.
     model: Gemini model name.
+    limiter: Optional rate limiter wrapping the API call.
+    mime_type: MIME type of image_data.
+    page_num: Page number, used only for retry logging.
 
   Returns:
     List of PatternGrid objects extracted from the page.
   """
-  from google.genai import types
-
-  image_data = image_path.read_bytes()
   image_part = types.Part.from_bytes(
-    data=image_data, mime_type="image/png"
+    data=image_data, mime_type=mime_type
   )
+  parsed = generate_with_retry(
+    client, model, [image_part], PageResponse, limiter,
+    f"Page {page_num}",
+  )
+  return parsed.patterns
 
-  response = client.models.generate_content(
-    model=model,
-    contents=[image_part, EXTRACTION_PROMPT],
-    config=types.GenerateContentConfig(
-      response_mime_type="application/json",
-      response_schema=PageResponse,
-      thinking_config=types.ThinkingConfig(
-        thinking_level="high",
-      ),
-      media_resolution="MEDIA_RESOLUTION_HIGH",
-    ),
+
+def send_batch_to_gemini(
+  client: genai.Client,
+  images: list[PageImage],
+  model: str,
+  limiter: RateLimiter | None = None,
+) -> list[list[PatternGrid]]:
+  """Send several page images to Gemini in one request.
+
+  Each image is preceded by a PAGE_N label and the response is
+  mapped back to pages by page_index. A single image falls back
+  to the plain per-page request.
+
+  Args:
+    client: Gemini API client.
+    images: Pages to extract, as (page_num, data, mime_type).
+    model: Gemini model name.
+    limiter: Optional rate limiter wrapping the API call.
+
+  Returns:
+    One list of PatternGrid objects per input image, in order.
+  """
+  if len(images) == 1:
+    page_num, image_data, mime_type = images[0]
+    return [
+      send_to_gemini(
+        client, image_data, model, limiter, mime_type, page_num
+      )
+    ]
+
+  contents: list[Any] = []
+  for idx, (_, image_data, mime_type) in enumerate(images, 1):
+    contents.append(f"PAGE_{idx}")
+    contents.append(
+      types.Part.from_bytes(data=image_data, mime_type=mime_type)
+    )
+  contents.append(BATCH_PROMPT.format(count=len(images)))
+
+  page_nums = [page_num for page_num, _, _ in images]
+  parsed = generate_with_retry(
+    client, model, contents, PagedResponse, limiter,
+    pages_label(page_nums),
   )
 
-  return response.parsed.patterns
+  by_index = {p.page_index: p.patterns for p in parsed.pages}
+  results = []
+  for idx, page_num in enumerate(page_nums, 1):
+    if idx not in by_index:
+      logger.warning(
+        "Page %d: missing from batch response", page_num
+      )
+    results.append(by_index.get(idx, []))
+  return results
+
+
+def pages_label(page_nums: list[int]) -> str:
+  """Format page numbers for progress messages.
+
+  Args:
+    page_nums: Page numbers, in order.
+
+  Returns:
+    'Page 9' for one page, 'Pages 9, 10, 12' for several.
+  """
+  if len(page_nums) == 1:
+    return f"Page {page_nums[0]}"
+  return "Pages " + ", ".join(str(n) for n in page_nums)
 
 
 def grid_to_steps_dict(grid: PatternGrid) -> dict[str, str]:
@@ -374,6 +719,35 @@ def cells_to_binary_string(cells: list[Cell]) -> str:
   return "".join("1" if c.filled else "0" for c in sorted_cells)
 
 
+def pack_steps(step_str: str) -> int:
+  """Pack a binary step string into an integer bitmask.
+
+  Args:
+    step_str: String of '0' and '1' characters, first step
+      leftmost.
+
+  Returns:
+    Integer whose binary digits are the steps.
+  """
+  return int(step_str, 2)
+
+
+def unpack_steps(value: int | str, width: int) -> str:
+  """Expand a packed step bitmask back to a binary string.
+
+  Args:
+    value: Bitmask from pack_steps, or an already-unpacked
+      binary string (legacy consensus files).
+    width: Number of steps in the row.
+
+  Returns:
+    String of '0' and '1' characters.
+  """
+  if isinstance(value, str):
+    return value
+  return format(value, f"0{width}b")
+
+
 def compute_consensus(
   passes: list[dict[str, str]],
   grid_width: int,
@@ -441,6 +815,29 @@ def parse_page_range(
   )
 
 
+def positive_int(value: str) -> int:
+  """Parse a CLI argument that must be at least 1.
+
+  Args:
+    value: Raw argument string.
+
+  Returns:
+    The parsed integer.
+
+  Raises:
+    argparse.ArgumentTypeError: If value is not an integer >= 1.
+  """
+  try:
+    number = int(value)
+  except ValueError:
+    number = 0
+  if number < 1:
+    raise argparse.ArgumentTypeError(
+      f"must be a positive integer, got '{value}'"
+    )
+  return number
+
+
 def name_to_id(name: str) -> str:
   """Convert pattern name to an ID slug.
 
@@ -451,9 +848,9 @@ def name_to_id(name: str) -> str:
     Lowercase slug, e.g. 'afro-cub-1'.
   """
   s = name.lower()
-  s = re.sub(r":\s*", "-", s)
-  s = re.sub(r"[^a-z0-9\-]", "-", s)
-  s = re.sub(r"-+", "-", s)
+  s = _COLON_RE.sub("-", s)
+  s = _NONALNUM_RE.sub("-", s)
+  s = _MULTIHYPHEN_RE.sub("-", s)
   s = s.strip("-")
   return s
 
@@ -467,8 +864,8 @@ def clean_name(name: str) -> str:
   Returns:
     Cleaned display name, e.g. 'Afro-Cub 1'.
   """
-  s = re.sub(r":\s*", " ", name)
-  s = re.sub(r"\s+", " ", s).strip()
+  s = _COLON_RE.sub(" ", name)
+  s = _WS_RE.sub(" ", s).strip()
   parts = s.split(" ")
   titled = []
   for part in parts:
@@ -486,7 +883,7 @@ def normalize_pattern(raw: dict) -> dict | None:
   Args:
     raw: Dict with 'name', 'grid_width', and 'steps' keys.
       Steps maps PDF instrument names (e.g. 'BD') to binary
-      strings.
+      strings or packed bitmasks.
 
   Returns:
     Normalized pattern dict with 'id', 'name', and 'steps'
@@ -510,11 +907,8 @@ def normalize_pattern(raw: dict) -> dict | None:
   steps: dict[str, str] = {}
   raw_steps = raw.get("steps", {})
   for pdf_key, track_id in INSTRUMENT_MAP.items():
-    step_str = raw_steps.get(pdf_key, "0" * 16)
-    if (
-      len(step_str) != 16
-      or not all(c in "01" for c in step_str)
-    ):
+    step_str = unpack_steps(raw_steps.get(pdf_key, 0), 16)
+    if not _STEP_RE.fullmatch(step_str):
       logger.warning(
         "Invalid step string for %s in '%s': '%s'",
         pdf_key, name, step_str,
@@ -533,41 +927,151 @@ def normalize_pattern(raw: dict) -> dict | None:
   }
 
 
+def render_page(
+  pdf: pdfium.PdfDocument,
+  page_num: int,
+  lock: "threading.Lock | None" = None,
+) -> bytes:
+  """Render a single PDF page to PNG bytes in-process.
+
+  PDFium is not thread-safe, so when one document is shared
+  across threads every PDFium call (page load, render, close)
+  happens under lock. The bitmap is copied into a Pillow image
+  before the lock is released, so PNG encoding runs in parallel.
+
+  Args:
+    pdf: Open PDF document.
+    page_num: PDF page number to render (1-indexed).
+    lock: Lock guarding pdf, if it is shared across threads.
+
+  Returns:
+    PNG image bytes at RENDER_DPI.
+  """
+  with lock or contextlib.nullcontext():
+    page = pdf[page_num - 1]
+    bitmap = page.render(scale=RENDER_DPI / 72)
+    image = bitmap.to_pil()
+    bitmap.close()
+    page.close()
+  buf = io.BytesIO()
+  image.save(buf, "PNG", optimize=False)
+  return buf.getvalue()
+
+
 def render_page_to_disk(
-  pdf_path: Path,
+  pdf: pdfium.PdfDocument,
   page_num: int,
   output_path: Path,
+  lock: "threading.Lock | None" = None,
 ) -> None:
   """Render a single PDF page to PNG on disk.
 
   Args:
-    pdf_path: Path to the PDF file.
-    page_num: PDF page number to render.
+    pdf: Open PDF document.
+    page_num: PDF page number to render (1-indexed).
     output_path: Where to write the PNG file.
+    lock: Lock guarding pdf, if it is shared across threads.
   """
-  with tempfile.TemporaryDirectory() as tmpdir:
-    prefix = os.path.join(tmpdir, "page")
-    subprocess.run(
-      [
-        "pdftoppm", "-png",
-        "-f", str(page_num),
-        "-l", str(page_num),
-        "-r", "300",
-        str(pdf_path), prefix,
-      ],
-      check=True,
-      capture_output=True,
-    )
-    pngs = list(Path(tmpdir).glob("*.png"))
-    if not pngs:
-      raise RuntimeError(
-        f"pdftoppm produced no output for page {page_num}"
-      )
-    shutil.move(str(pngs[0]), str(output_path))
+  output_path.write_bytes(render_page(pdf, page_num, lock))
+
+
+def pdf_content_hash(pdf_path: Path) -> str:
+  """Short content hash of a PDF, used to key the render cache.
+
+  Args:
+    pdf_path: Path to the PDF file.
+
+  Returns:
+    First 16 hex digits of the file's SHA-256.
+  """
+  with pdf_path.open("rb") as f:
+    return hashlib.file_digest(f, "sha256").hexdigest()[:16]
+
+
+def render_cache_path(
+  pdf_hash: str, page_num: int, dpi: int, fmt: str
+) -> Path:
+  """Path of a page's cached upload image.
+
+  The key covers every input to encode_for_upload, including
+  RENDER_DPI and JPEG_QUALITY, so changing either constant
+  misses the old entries instead of silently reusing them.
+
+  Args:
+    pdf_hash: Content hash of the PDF.
+    page_num: PDF page number.
+    dpi: Upload resolution.
+    fmt: Upload format, 'jpeg' or 'png'.
+
+  Returns:
+    Path inside RENDER_CACHE_DIR.
+  """
+  return RENDER_CACHE_DIR / (
+    f"{pdf_hash}_{page_num:03d}_r{RENDER_DPI}_{dpi}"
+    f"_q{JPEG_QUALITY}.{fmt}"
+  )
+
+
+def load_upload_image(
+  pdf: pdfium.PdfDocument | None,
+  pdf_hash: str | None,
+  page_num: int,
+  dpi: int,
+  fmt: str,
+) -> tuple[bytes, str] | None:
+  """Get the encoded upload image for a page, rendering if needed.
+
+  Checks RENDER_CACHE_DIR first (see render_cache_path), then
+  the extracted PNG in IMAGES_DIR, and only then renders from
+  the PDF. Fresh results are written back to the cache so reruns
+  skip rendering and encoding entirely.
+
+  Args:
+    pdf: Open PDF document, or None if the PDF is missing.
+    pdf_hash: Content hash of the PDF, or None to bypass the
+      cache.
+    page_num: PDF page number.
+    dpi: Upload resolution.
+    fmt: Upload format, 'jpeg' or 'png'.
+
+  Returns:
+    Tuple of (image bytes, MIME type), or None if there is no
+    image and no PDF to render it from.
+  """
+  cache_file = None
+  if pdf_hash is not None:
+    cache_file = render_cache_path(pdf_hash, page_num, dpi, fmt)
+    if cache_file.exists():
+      return cache_file.read_bytes(), UPLOAD_MIME_TYPES[fmt]
+
+  image_path = IMAGES_DIR / f"page_{page_num:03d}.png"
+  if image_path.exists():
+    png_data = image_path.read_bytes()
+  elif pdf is not None:
+    # Keep the fresh render in memory rather than reading back
+    # the file just written for the report and CV pipeline.
+    print(f"Page {page_num}: rendering...")
+    png_data = render_page(pdf, page_num)
+    image_path.write_bytes(png_data)
+  else:
+    return None
+
+  image_data, mime_type = encode_for_upload(png_data, dpi, fmt)
+  if cache_file is not None:
+    # Any existing entry counts as a hit, so swap it in whole
+    # rather than risk an interrupted write leaving it truncated.
+    tmp_path = cache_file.with_suffix(f".{fmt}.tmp")
+    tmp_path.write_bytes(image_data)
+    os.replace(tmp_path, cache_file)
+  return image_data, mime_type
 
 
 def do_extract(args: argparse.Namespace) -> None:
-  """Render PDF pages to PNG images."""
+  """Render PDF pages to PNG images.
+
+  One PdfDocument is parsed once and shared by a thread pool;
+  see render_page for how PDFium access is serialized.
+  """
   pdf_path = Path(args.pdf).expanduser()
   if not pdf_path.exists():
     logger.error("PDF not found: %s", pdf_path)
@@ -576,148 +1080,482 @@ def do_extract(args: argparse.Namespace) -> None:
   start, end = parse_page_range(args.pages)
   IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 
-  for page_num in range(start, end + 1):
-    output_path = IMAGES_DIR / f"page_{page_num:03d}.png"
-    if output_path.exists():
-      print(f"Page {page_num}: image exists, skipping")
-      continue
-    print(f"Page {page_num}: rendering...")
-    render_page_to_disk(pdf_path, page_num, output_path)
+  pdf = pdfium.PdfDocument(pdf_path)
+  lock = threading.Lock()
+  try:
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+      futures = []
+      for page_num in range(start, end + 1):
+        output_path = IMAGES_DIR / f"page_{page_num:03d}.png"
+        if output_path.exists():
+          print(f"Page {page_num}: image exists, skipping")
+          continue
+        print(f"Page {page_num}: rendering...")
+        futures.append(
+          executor.submit(
+            render_page_to_disk, pdf, page_num, output_path, lock
+          )
+        )
+      for future in futures:
+        future.result()
+  finally:
+    pdf.close()
 
   print(f"Done. Images in {IMAGES_DIR}")
 
 
-def do_parse(args: argparse.Namespace) -> None:
-  """Send images to Gemini for pattern extraction."""
-  from google import genai
-
-  start, end = parse_page_range(args.pages)
-  num_passes = args.passes
-  model = args.model
-
-  api_key = os.environ.get("GEMINI_API_KEY")
-  if not api_key:
-    logger.error("GEMINI_API_KEY environment variable not set")
-    sys.exit(1)
-
-  client = genai.Client(api_key=api_key)
-
-  PASSES_DIR.mkdir(parents=True, exist_ok=True)
-  CONSENSUS_DIR.mkdir(parents=True, exist_ok=True)
+def process_batch(
+  client: genai.Client,
+  batch: list[PageImage],
+  args: argparse.Namespace,
+  limiter: RateLimiter,
+) -> int:
+  """Run all Gemini passes for a batch of pages and save results.
 
-  for page_num in range(start, end + 1):
-    image_path = IMAGES_DIR / f"page_{page_num:03d}.png"
-    if not image_path.exists():
-      print(f"Page {page_num}: no image, run extract first")
-      continue
+  Each pass sends every page still missing that pass in a single
+  request. Safe to call concurrently for disjoint batches: every
+  file it reads or writes is specific to one of its pages.
 
-    consensus_path = (
-      CONSENSUS_DIR / f"page_{page_num:03d}.json"
-    )
-    if consensus_path.exists() and not args.force:
-      print(f"Page {page_num}: consensus exists, skipping")
-      continue
+  Args:
+    client: Gemini API client, shared across threads.
+    batch: Pages to process, as (page_num, data, mime_type).
+    args: Parsed CLI arguments for the parse command.
+    limiter: Rate limiter shared by all page workers.
 
-    # Run multiple passes
-    all_pass_grids: list[list[PatternGrid]] = []
-    for pass_idx in range(1, num_passes + 1):
+  Returns:
+    Number of consensus patterns saved for the batch.
+  """
+  all_pass_grids: dict[int, list[list[PatternGrid]]] = {
+    page_num: [] for page_num, _, _ in batch
+  }
+  for pass_idx in range(1, args.passes + 1):
+    to_send: list[PageImage] = []
+    for item in batch:
+      page_num = item[0]
       pass_path = (
         PASSES_DIR
         / f"page_{page_num:03d}_pass{pass_idx}.json"
       )
-
       if pass_path.exists() and not args.force:
         print(
           f"Page {page_num} pass {pass_idx}: "
           f"exists, loading"
         )
         raw = json.loads(pass_path.read_text())
-        grids = [PatternGrid(**g) for g in raw]
-      else:
-        print(
-          f"Page {page_num} pass {pass_idx}: "
-          f"sending to Gemini..."
+        all_pass_grids[page_num].append(
+          [PatternGrid(**g) for g in raw]
         )
-        try:
-          grids = send_to_gemini(client, image_path, model)
-        except Exception as e:
-          logger.error(
-            "Page %d pass %d: ERROR - %s",
-            page_num, pass_idx, e,
-          )
-          grids = []
+      else:
+        to_send.append(item)
 
-        # Save raw pass result
-        pass_path.write_text(
-          json.dumps(
-            [g.model_dump() for g in grids], indent=2
-          )
-          + "\n"
-        )
-        time.sleep(1)  # Rate limiting
+    if not to_send:
+      continue
 
-      all_pass_grids.append(grids)
+    label = pages_label([page_num for page_num, _, _ in to_send])
+    print(f"{label} pass {pass_idx}: sending to Gemini...")
+    try:
+      results = send_batch_to_gemini(
+        client, to_send, args.model, limiter
+      )
+    except Exception as e:
+      logger.error(
+        "%s pass %d: ERROR - %s", label, pass_idx, e,
+      )
+      results = [[] for _ in to_send]
 
-    # Build consensus
-    if not all_pass_grids or not all_pass_grids[0]:
-      print(f"Page {page_num}: no patterns found")
-      consensus_path.write_text(
-        json.dumps({"page": page_num, "patterns": []})
+    for (page_num, _, _), grids in zip(
+      to_send, results, strict=True
+    ):
+      # Save raw pass result
+      pass_path = (
+        PASSES_DIR
+        / f"page_{page_num:03d}_pass{pass_idx}.json"
+      )
+      pass_path.write_text(
+        json.dumps(
+          [g.model_dump() for g in grids], indent=2
+        )
         + "\n"
       )
-      continue
+      all_pass_grids[page_num].append(grids)
 
-    # Use first pass as reference for pattern count/names
-    reference = all_pass_grids[0]
-    consensus_patterns = []
-    total_flagged = 0
-
-    for pat_idx, ref_grid in enumerate(reference):
-      # Collect this pattern's steps from each pass
-      pass_steps: list[dict[str, str]] = []
-      for pass_grids in all_pass_grids:
-        if pat_idx < len(pass_grids):
-          pass_steps.append(
-            grid_to_steps_dict(pass_grids[pat_idx])
-          )
+  return sum(
+    save_consensus(page_num, pass_grids, not args.legacy_strings)
+    for page_num, pass_grids in all_pass_grids.items()
+  )
 
-      if not pass_steps:
-        continue
 
-      consensus_steps, flagged = compute_consensus(
-        pass_steps, ref_grid.grid_width
-      )
-      total_flagged += flagged
-
-      consensus_patterns.append({
-        "name": ref_grid.name,
-        "grid_width": ref_grid.grid_width,
-        "steps": consensus_steps,
-        "flagged_count": flagged,
-      })
-
-    # Save consensus
-    consensus_data = {
-      "page": page_num,
-      "patterns": consensus_patterns,
-      "total_flagged": total_flagged,
-    }
+def save_consensus(
+  page_num: int,
+  all_pass_grids: list[list[PatternGrid]],
+  packed: bool = True,
+) -> int:
+  """Build and save the consensus for one page.
+
+  Args:
+    page_num: PDF page number.
+    all_pass_grids: Grids from each pass, in pass order.
+    packed: Store each row as an integer bitmask (see
+      pack_steps) instead of a binary string.
+
+  Returns:
+    Number of consensus patterns saved for the page.
+  """
+  consensus_path = (
+    CONSENSUS_DIR / f"page_{page_num:03d}.json"
+  )
+
+  # Build consensus
+  if not all_pass_grids or not all_pass_grids[0]:
+    print(f"Page {page_num}: no patterns found")
     consensus_path.write_text(
-      json.dumps(consensus_data, indent=2) + "\n"
+      json.dumps({"page": page_num, "patterns": []})
+      + "\n"
     )
+    return 0
+
+  # Use first pass as reference for pattern count/names
+  reference = all_pass_grids[0]
+  consensus_patterns = []
+  total_flagged = 0
+
+  for pat_idx, ref_grid in enumerate(reference):
+    # A width below 1 gives empty rows, which cannot be packed
+    if ref_grid.grid_width < 1:
+      logger.warning(
+        "Page %d: skipping %r with grid_width %d",
+        page_num, ref_grid.name, ref_grid.grid_width,
+      )
+      continue
+
+    # Collect this pattern's steps from each pass
+    pass_steps: list[dict[str, str]] = []
+    for pass_grids in all_pass_grids:
+      if pat_idx < len(pass_grids):
+        pass_steps.append(
+          grid_to_steps_dict(pass_grids[pat_idx])
+        )
+
+    if not pass_steps:
+      continue
 
-    names = [p["name"] for p in consensus_patterns]
-    flag_msg = (
-      f" ({total_flagged} flagged cells)"
-      if total_flagged
-      else ""
+    consensus_steps, flagged = compute_consensus(
+      pass_steps, ref_grid.grid_width
     )
-    print(
-      f"Page {page_num}: {len(consensus_patterns)} "
-      f"patterns{flag_msg} {names}"
+    total_flagged += flagged
+
+    consensus_patterns.append({
+      "name": ref_grid.name,
+      "grid_width": ref_grid.grid_width,
+      "steps": (
+        {k: pack_steps(v) for k, v in consensus_steps.items()}
+        if packed
+        else consensus_steps
+      ),
+      "flagged_count": flagged,
+    })
+
+  # Save consensus
+  consensus_data = {
+    "page": page_num,
+    "patterns": consensus_patterns,
+    "total_flagged": total_flagged,
+  }
+  consensus_path.write_text(
+    json.dumps(consensus_data, indent=2) + "\n"
+  )
+
+  names = [p["name"] for p in consensus_patterns]
+  flag_msg = (
+    f" ({total_flagged} flagged cells)"
+    if total_flagged
+    else ""
+  )
+  print(
+    f"Page {page_num}: {len(consensus_patterns)} "
+    f"patterns{flag_msg} {names}"
+  )
+  return len(consensus_patterns)
+
+
+def route_page(
+  item: PageImage,
+  is_grid: Future[bool] | None,
+  batch: list[PageImage],
+  pages: "queue.Queue[list[PageImage] | None]",
+  batch_size: int,
+) -> list[PageImage]:
+  """Add a loaded page to the current batch, or drop it.
+
+  Pages whose prefilter result is False never reach Gemini.
+  No consensus is written for them, so a later run without
+  --prefilter sends them. If the prefilter itself
+  fails, the page is sent anyway. Full batches are put on the
+  queue.
+
+  Args:
+    item: Page ready for upload.
+    is_grid: Pending looks_like_grid_page result, or None when
+      prefiltering is disabled.
+    batch: Batch being filled.
+    pages: Queue of page batches.
+    batch_size: Pages per batch.
+
+  Returns:
+    The batch to keep filling.
+  """
+  page_num = item[0]
+  has_grid = True
+  if is_grid is not None:
+    try:
+      has_grid = is_grid.result()
+    # Fail open: the prefilter only saves requests, so no error
+    # in it (cancelled, broken pool, bad image) may drop a page.
+    except Exception as e:  # noqa: BLE001
+      logger.warning(
+        "Page %d: prefilter ERROR, sending anyway - %s",
+        page_num, e,
+      )
+  if not has_grid:
+    logger.warning(
+      "Page %d: no grid detected, skipping Gemini "
+      "(rerun without --prefilter to send it)",
+      page_num,
     )
+    return batch
+
+  batch.append(item)
+  if len(batch) >= batch_size:
+    pages.put(batch)
+    return []
+  return batch
+
+
+def render_worker(
+  pdf: pdfium.PdfDocument | None,
+  pdf_hash: str | None,
+  page_nums: range,
+  args: argparse.Namespace,
+  pages: "queue.Queue[list[PageImage] | None]",
+  num_consumers: int,
+  prefilter_pool: ProcessPoolExecutor | None,
+  stop: threading.Event,
+) -> None:
+  """Producer stage: load or render page images onto a queue.
+
+  Images come from load_upload_image, so rendering keeps
+  working while Gemini requests are in flight. Each page's
+  RENDER_DPI image in IMAGES_DIR is handed to prefilter_pool
+  for looks_like_grid_page, keeping the CPU-bound check off
+  this thread and the Gemini threads. A page whose image is
+  missing (only its cached upload survives) skips the check.
+  Up to PREFILTER_WINDOW results are left pending so the check
+  overlaps with loading the next pages; pages are routed in
+  order, grouped into batches of --batch-size. Always finishes
+  by enqueueing one None sentinel per consumer.
+
+  Args:
+    pdf: Open PDF document, or None if the PDF is missing.
+    pdf_hash: Content hash of the PDF for the render cache.
+    page_nums: Page numbers to process, in order.
+    args: Parsed CLI arguments for the parse command.
+    pages: Bounded queue of page batches.
+    num_consumers: Number of Gemini workers to stop.
+    prefilter_pool: Process pool for the grid prefilter, or
+      None to send every page to Gemini.
+    stop: Set when the run is interrupted; no further pages
+      are loaded.
+  """
+  try:
+    batch: list[PageImage] = []
+    in_flight: deque[tuple[PageImage, Future[bool] | None]] = deque()
+    for page_num in page_nums:
+      if stop.is_set():
+        return
+      consensus_path = (
+        CONSENSUS_DIR / f"page_{page_num:03d}.json"
+      )
+      if consensus_path.exists() and not args.force:
+        print(f"Page {page_num}: consensus exists, skipping")
+        continue
 
-  print("Done.")
+      try:
+        upload = load_upload_image(
+          pdf, pdf_hash, page_num, args.dpi, args.format
+        )
+      except (IndexError, OSError, pdfium.PdfiumError) as e:
+        logger.error(
+          "Page %d: image ERROR - %s", page_num, e
+        )
+        continue
+      if upload is None:
+        print(f"Page {page_num}: no image, run extract first")
+        continue
+
+      # The child reads the full-resolution image itself, so
+      # only the path is pickled across.
+      image_path = IMAGES_DIR / f"page_{page_num:03d}.png"
+      is_grid = None
+      if prefilter_pool is not None and image_path.exists():
+        try:
+          is_grid = prefilter_pool.submit(
+            looks_like_grid_page, image_path
+          )
+        except RuntimeError as e:
+          # Shut down by an interrupted run, or broken
+          if stop.is_set():
+            return
+          logger.warning(
+            "Page %d: prefilter ERROR, sending anyway - %s",
+            page_num, e,
+          )
+      in_flight.append(((page_num, *upload), is_grid))
+      if len(in_flight) > PREFILTER_WINDOW:
+        batch = route_page(
+          *in_flight.popleft(), batch, pages, args.batch_size
+        )
+
+    while in_flight:
+      batch = route_page(
+        *in_flight.popleft(), batch, pages, args.batch_size
+      )
+    if batch:
+      pages.put(batch)
+  finally:
+    for _ in range(num_consumers):
+      pages.put(None)
+
+
+def gemini_worker(
+  client: genai.Client,
+  args: argparse.Namespace,
+  limiter: RateLimiter,
+  pages: "queue.Queue[list[PageImage] | None]",
+  totals: list[int],
+  stop: threading.Event,
+) -> None:
+  """Consumer stage: run Gemini passes for queued batches.
+
+  Args:
+    client: Gemini API client, shared across threads.
+    args: Parsed CLI arguments for the parse command.
+    limiter: Rate limiter shared by all workers.
+    pages: Queue of page batches; None stops the worker.
+    totals: List to append this worker's pattern count to.
+    stop: Set when the run is interrupted; no further batches
+      are sent.
+  """
+  count = 0
+  while (batch := pages.get()) is not None and not stop.is_set():
+    try:
+      count += process_batch(client, batch, args, limiter)
+    # Deliberately broad: a dead worker would leave the producer
+    # blocked on the bounded queue and stall the whole run.
+    except Exception as e:  # noqa: BLE001
+      label = pages_label([page_num for page_num, _, _ in batch])
+      logger.error("%s: ERROR - %s", label, e)
+  totals.append(count)
+
+
+def do_parse(args: argparse.Namespace) -> None:
+  """Send page images to Gemini for pattern extraction.
+
+  Pages without an extracted image are rendered from the PDF,
+  so running extract first is optional. Runs as a staged
+  pipeline: one thread renders (or loads) page images, a
+  process pool runs the grid prefilter if --prefilter is set,
+  and surviving pages go into a bounded queue of --batch-size
+  batches while --concurrency worker threads send them to
+  Gemini. The shared RateLimiter keeps the request rate in
+  check.
+  """
+  start, end = parse_page_range(args.pages)
+  pdf_path = Path(args.pdf).expanduser()
+
+  api_key = os.environ.get("GEMINI_API_KEY")
+  if not api_key:
+    logger.error("GEMINI_API_KEY environment variable not set")
+    sys.exit(1)
+
+  # One client is shared by every worker thread. It is
+  # thread-safe, and its pooled httpx connections keep TLS
+  # sessions alive across requests.
+  pool_size = args.concurrency * 2
+  client = genai.Client(
+    api_key=api_key,
+    http_options=types.HttpOptions(
+      timeout=REQUEST_TIMEOUT_MS,
+      client_args={
+        "limits": httpx.Limits(
+          max_connections=pool_size,
+          max_keepalive_connections=pool_size,
+        ),
+      },
+    ),
+  )
+  limiter = RateLimiter(args.concurrency)
+
+  IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+  RENDER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+  PASSES_DIR.mkdir(parents=True, exist_ok=True)
+  CONSENSUS_DIR.mkdir(parents=True, exist_ok=True)
+
+  pages: queue.Queue[list[PageImage] | None] = (
+    queue.Queue(maxsize=args.concurrency * 2)
+  )
+  pdf = None
+  pdf_hash = None
+  if pdf_path.exists():
+    pdf = pdfium.PdfDocument(pdf_path)
+    pdf_hash = pdf_content_hash(pdf_path)
+  # The grid prefilter is CPU-bound, so it gets its own
+  # processes. Spawn rather than fork: by the time it starts,
+  # this process is running threads.
+  prefilter_pool = (
+    ProcessPoolExecutor(
+      max_workers=PREFILTER_WORKERS,
+      mp_context=multiprocessing.get_context("spawn"),
+    )
+    if args.prefilter
+    else None
+  )
+  totals: list[int] = []
+  stop = threading.Event()
+  # Daemon threads, so Ctrl-C ends the run without waiting for
+  # in-flight requests; stop keeps them from starting new work
+  # while the cleanup below runs.
+  threads = [
+    threading.Thread(
+      target=render_worker,
+      args=(
+        pdf, pdf_hash, range(start, end + 1), args, pages,
+        args.concurrency, prefilter_pool, stop,
+      ),
+      daemon=True,
+    ),
+  ]
+  threads.extend(
+    threading.Thread(
+      target=gemini_worker,
+      args=(client, args, limiter, pages, totals, stop),
+      daemon=True,
+    )
+    for _ in range(args.concurrency)
+  )
+  try:
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+  finally:
+    stop.set()
+    if prefilter_pool is not None:
+      prefilter_pool.shutdown(cancel_futures=True)
+    # An interrupted producer may still be rendering from pdf.
+    if pdf is not None and not any(t.is_alive() for t in threads):
+      pdf.close()
+
+  print(f"Done. {sum(totals)} patterns.")
 
 
 def do_verify(args: argparse.Namespace) -> None:
@@ -748,6 +1586,11 @@ def do_verify(args: argparse.Namespace) -> None:
 
     data = json.loads(consensus_path.read_text())
     patterns = data.get("patterns", [])
+    for pat in patterns:
+      pat["steps"] = {
+        inst: unpack_steps(v, pat["grid_width"])
+        for inst, v in pat["steps"].items()
+      }
     total_patterns += len(patterns)
     total_flagged += data.get("total_flagged", 0)
 
@@ -810,6 +1653,8 @@ def do_verify(args: argparse.Namespace) -> None:
 
 def do_merge(args: argparse.Namespace) -> None:
   """Merge consensus patterns into patterns.json."""
+  import orjson
+
   if not CONSENSUS_DIR.exists():
     logger.error(
       "No consensus directory. Run parse first."
@@ -825,7 +1670,7 @@ def do_merge(args: argparse.Namespace) -> None:
 
   parsed: dict[str, dict] = {}
   for cf in consensus_files:
-    data = json.loads(cf.read_text())
+    data = orjson.loads(cf.read_bytes())
     for raw in data.get("patterns", []):
       normalized = normalize_pattern(raw)
       if normalized:
@@ -836,7 +1681,7 @@ def do_merge(args: argparse.Namespace) -> None:
     f"from {len(consensus_files)} pages"
   )
 
-  existing_data = json.loads(PATTERNS_JSON.read_text())
+  existing_data = orjson.loads(PATTERNS_JSON.read_bytes())
   existing = {
     p["id"]: p for p in existing_data["patterns"]
   }
@@ -861,9 +1706,16 @@ def do_merge(args: argparse.Namespace) -> None:
     merged.values(), key=lambda p: p["id"]
   )
   output = {"patterns": sorted_patterns}
-  PATTERNS_JSON.write_text(
-    json.dumps(output, indent=2) + "\n"
+  # Write to a sibling temp file and swap it in, so an
+  # interrupted merge never leaves patterns.json truncated.
+  tmp_path = PATTERNS_JSON.with_suffix(".json.tmp")
+  tmp_path.write_bytes(
+    orjson.dumps(
+      output,
+      option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE,
+    )
   )
+  os.replace(tmp_path, PATTERNS_JSON)
 
   print(
     f"Wrote {len(sorted_patterns)} patterns "
@@ -904,7 +1756,7 @@ def main() -> None:
 
   parse_cmd = sub.add_parser(
     "parse",
-    help="Send images to Gemini for extraction",
+    help="Render missing pages and send them to Gemini",
   )
   parse_cmd.add_argument(
     "--passes",
@@ -922,6 +1774,58 @@ def main() -> None:
     default=MODEL,
     help=f"Gemini model to use (default: {MODEL})",
   )
+  parse_cmd.add_argument(
+    "--prefilter",
+    action="store_true",
+    help=(
+      "Skip Gemini for pages where no grid is detected locally; "
+      "faint, small or skewed grids may be missed"
+    ),
+  )
+  parse_cmd.add_argument(
+    "--legacy-strings",
+    action="store_true",
+    help=(
+      "Store consensus steps as binary strings instead of "
+      "integer bitmasks"
+    ),
+  )
+  parse_cmd.add_argument(
+    "--dpi",
+    type=int,
+    default=DEFAULT_UPLOAD_DPI,
+    help=(
+      "Resolution of images sent to Gemini "
+      f"(default: {DEFAULT_UPLOAD_DPI})"
+    ),
+  )
+  parse_cmd.add_argument(
+    "--format",
+    choices=sorted(UPLOAD_MIME_TYPES),
+    default=DEFAULT_UPLOAD_FORMAT,
+    help=(
+      "Encoding of images sent to Gemini "
+      f"(default: {DEFAULT_UPLOAD_FORMAT})"
+    ),
+  )
+  parse_cmd.add_argument(
+    "--batch-size",
+    type=positive_int,
+    default=DEFAULT_BATCH_SIZE,
+    help=(
+      "Pages sent per Gemini request "
+      f"(default: {DEFAULT_BATCH_SIZE})"
+    ),
+  )
+  parse_cmd.add_argument(
+    "--concurrency",
+    type=positive_int,
+    default=DEFAULT_CONCURRENCY,
+    help=(
+      "Pages processed in parallel "
+      f"(default: {DEFAULT_CONCURRENCY})"
+    ),
+  )
 
   sub.add_parser(
     "verify",
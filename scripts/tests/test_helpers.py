@@ -1,7 +1,22 @@
 """Tests for parse_pdf_patterns helper functions."""
 
+import argparse
+import io
+import json
+import queue
 import sys
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
 from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from google.genai import errors
+from PIL import Image, ImageDraw
+from pydantic import BaseModel
 
 sys.path.insert(
   0, str(Path(__file__).resolve().parent.parent)
@@ -9,6 +24,44 @@ sys.path.insert(
 import parse_pdf_patterns as pp
 
 
+def _fake_client(
+  respond: Callable[[dict[str, Any]], BaseModel],
+) -> tuple[Any, list[dict[str, Any]]]:
+  """Build a stand-in for genai.Client.
+
+  Args:
+    respond: Called with each generate_content call's kwargs;
+      returns the parsed response or raises.
+
+  Returns:
+    Tuple of (client, list of recorded call kwargs).
+  """
+  calls: list[dict[str, Any]] = []
+
+  def generate_content(**kwargs: Any) -> SimpleNamespace:
+    calls.append(kwargs)
+    return SimpleNamespace(parsed=respond(kwargs))
+
+  client = SimpleNamespace(
+    models=SimpleNamespace(generate_content=generate_content)
+  )
+  return client, calls
+
+
+def _png(width: int, height: int) -> bytes:
+  """Encode a blank white PNG of the given size."""
+  buf = io.BytesIO()
+  Image.new("RGB", (width, height), "white").save(buf, "PNG")
+  return buf.getvalue()
+
+
+def _done(value: bool) -> Future[bool]:
+  """Build an already-resolved prefilter future."""
+  future: Future[bool] = Future()
+  future.set_result(value)
+  return future
+
+
 class TestParsePageRange:
   """Tests for parse_page_range."""
 
@@ -28,12 +81,22 @@ class TestParsePageRange:
     assert pp.parse_page_range(None, 1, 50) == (1, 50)
 
   def test_invalid_raises(self) -> None:
-    import pytest
-
     with pytest.raises(ValueError):
       pp.parse_page_range("abc")
 
 
+class TestPositiveInt:
+  """Tests for positive_int."""
+
+  def test_accepts_positive(self) -> None:
+    assert pp.positive_int("4") == 4
+
+  def test_rejects_zero_and_garbage(self) -> None:
+    for value in ("0", "-2", "abc"):
+      with pytest.raises(argparse.ArgumentTypeError):
+        pp.positive_int(value)
+
+
 class TestNameToId:
   """Tests for name_to_id."""
 
@@ -144,6 +207,36 @@ class TestComputeConsensus:
     assert flagged == 0
 
 
+class TestPackSteps:
+  """Tests for pack_steps and unpack_steps."""
+
+  def test_round_trip(self) -> None:
+    row = "1000100010001010"
+    assert pp.pack_steps(row) == 0b1000100010001010
+    assert pp.unpack_steps(pp.pack_steps(row), 16) == row
+
+  def test_leading_zeros_preserved(self) -> None:
+    assert pp.unpack_steps(1, 16) == "0000000000000001"
+    assert pp.unpack_steps(0, 12) == "000000000000"
+
+  def test_string_passthrough(self) -> None:
+    assert pp.unpack_steps("0101", 4) == "0101"
+
+
+class TestSaveConsensus:
+  """Tests for save_consensus."""
+
+  def test_skips_zero_width_grid(
+    self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+  ) -> None:
+    monkeypatch.setattr(pp, "CONSENSUS_DIR", tmp_path)
+    bad = pp.PatternGrid(name="Rock: 1", grid_width=0, rows=[])
+    good = pp.PatternGrid(name="Rock: 2", grid_width=16, rows=[])
+    assert pp.save_consensus(9, [[bad, good], [bad, good]]) == 1
+    saved = json.loads((tmp_path / "page_009.json").read_text())
+    assert [p["name"] for p in saved["patterns"]] == ["Rock: 2"]
+
+
 class TestNormalizePattern:
   """Tests for normalize_pattern."""
 
@@ -191,6 +284,37 @@ class TestNormalizePattern:
     assert result is not None
     assert result["steps"]["bd"] == "0000000000000000"
 
+  def test_packed_steps(self) -> None:
+    raw = {
+      "name": "Rock: 1",
+      "grid_width": 16,
+      "steps": {"BD": 0b1000100010001000, "SD": 0},
+    }
+    result = pp.normalize_pattern(raw)
+    assert result is not None
+    assert result["steps"]["bd"] == "1000100010001000"
+    assert result["steps"]["sd"] == "0000000000000000"
+
+  def test_packed_steps_too_wide(self) -> None:
+    raw = {
+      "name": "Rock: 1",
+      "grid_width": 16,
+      "steps": {"BD": 1 << 16},
+    }
+    result = pp.normalize_pattern(raw)
+    assert result is not None
+    assert result["steps"]["bd"] == "0000000000000000"
+
+  def test_invalid_step_character(self) -> None:
+    raw = {
+      "name": "Pop: 1",
+      "grid_width": 16,
+      "steps": {"BD": "100010001000100x"},
+    }
+    result = pp.normalize_pattern(raw)
+    assert result is not None
+    assert result["steps"]["bd"] == "0000000000000000"
+
   def test_all_12_tracks(self) -> None:
     raw = {
       "name": "Test: 1",
@@ -202,3 +326,311 @@ class TestNormalizePattern:
     assert len(result["steps"]) == 12
     for tid in pp.ALL_TRACK_IDS:
       assert tid in result["steps"]
+
+
+class TestRateLimiter:
+  """Tests for RateLimiter."""
+
+  def test_spaces_request_starts(self) -> None:
+    limiter = pp.RateLimiter(4, min_interval=0.05)
+    starts = []
+    for _ in range(3):
+      with limiter:
+        starts.append(time.monotonic())
+    assert starts[1] - starts[0] >= 0.045
+    assert starts[2] - starts[1] >= 0.045
+
+  def test_bounds_concurrency(self) -> None:
+    limiter = pp.RateLimiter(2, min_interval=0.0)
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def work() -> None:
+      nonlocal active, peak
+      with limiter:
+        with lock:
+          active += 1
+          peak = max(peak, active)
+        time.sleep(0.02)
+        with lock:
+          active -= 1
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    assert peak == 2
+
+
+class TestEncodeForUpload:
+  """Tests for encode_for_upload."""
+
+  def test_jpeg_downscaled(self) -> None:
+    data, mime = pp.encode_for_upload(_png(300, 600), 200, "jpeg")
+    assert mime == "image/jpeg"
+    img = Image.open(io.BytesIO(data))
+    assert img.format == "JPEG"
+    assert img.size == (200, 400)
+
+  def test_png_at_render_dpi_passthrough(self) -> None:
+    png = _png(30, 60)
+    data, mime = pp.encode_for_upload(png, pp.RENDER_DPI, "png")
+    assert mime == "image/png"
+    assert data == png
+
+
+class TestLoadUploadImage:
+  """Tests for load_upload_image."""
+
+  def test_cache_hit_skips_render(
+    self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+  ) -> None:
+    monkeypatch.setattr(pp, "RENDER_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(pp, "IMAGES_DIR", tmp_path / "none")
+    pp.render_cache_path("abc", 9, 200, "jpeg").write_bytes(b"cached")
+    assert pp.load_upload_image(None, "abc", 9, 200, "jpeg") == (
+      b"cached",
+      "image/jpeg",
+    )
+
+  def test_no_image_no_pdf(
+    self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+  ) -> None:
+    monkeypatch.setattr(pp, "RENDER_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(pp, "IMAGES_DIR", tmp_path)
+    assert pp.load_upload_image(None, None, 9, 200, "jpeg") is None
+
+  def test_writes_cache(
+    self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+  ) -> None:
+    monkeypatch.setattr(pp, "RENDER_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(pp, "IMAGES_DIR", tmp_path)
+    (tmp_path / "page_009.png").write_bytes(_png(30, 30))
+    data, _ = pp.load_upload_image(None, "abc", 9, 200, "jpeg")
+    cache_file = pp.render_cache_path("abc", 9, 200, "jpeg")
+    assert cache_file.read_bytes() == data
+    assert not list(tmp_path.glob("*.tmp"))
+
+  def test_cache_key_covers_encoder_settings(
+    self, monkeypatch: pytest.MonkeyPatch
+  ) -> None:
+    before = pp.render_cache_path("abc", 9, 200, "jpeg")
+    monkeypatch.setattr(pp, "JPEG_QUALITY", pp.JPEG_QUALITY - 10)
+    assert pp.render_cache_path("abc", 9, 200, "jpeg") != before
+    monkeypatch.undo()
+    monkeypatch.setattr(pp, "RENDER_DPI", 600)
+    assert pp.render_cache_path("abc", 9, 200, "jpeg") != before
+
+
+class TestRetry:
+  """Tests for is_retryable and send_to_gemini retries."""
+
+  @pytest.fixture(autouse=True)
+  def _no_sleep(self, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(pp.time, "sleep", lambda _: None)
+
+  def test_rate_limit_retryable(self) -> None:
+    assert pp.is_retryable(errors.APIError(429, {}))
+    assert pp.is_retryable(errors.APIError(503, {}))
+
+  def test_client_error_not_retryable(self) -> None:
+    assert not pp.is_retryable(errors.APIError(400, {}))
+
+  def test_retries_then_succeeds(self) -> None:
+    def respond(kwargs: dict[str, Any]) -> pp.PageResponse:
+      if len(calls) < 3:
+        raise errors.APIError(429, {})
+      return pp.PageResponse(patterns=[])
+
+    client, calls = _fake_client(respond)
+    assert pp.send_to_gemini(client, b"img", "m") == []
+    assert len(calls) == 3
+
+  def test_gives_up_after_max_attempts(self) -> None:
+    def respond(kwargs: dict[str, Any]) -> pp.PageResponse:
+      raise errors.APIError(500, {})
+
+    client, calls = _fake_client(respond)
+    with pytest.raises(errors.APIError):
+      pp.send_to_gemini(client, b"img", "m")
+    assert len(calls) == pp.MAX_ATTEMPTS
+
+
+class TestSendBatchToGemini:
+  """Tests for send_batch_to_gemini and pages_label."""
+
+  def test_pages_label(self) -> None:
+    assert pp.pages_label([9]) == "Page 9"
+    assert pp.pages_label([9, 10, 12]) == "Pages 9, 10, 12"
+
+  def test_maps_results_by_page_index(self) -> None:
+    grid = pp.PatternGrid(name="Rock: 1", grid_width=16, rows=[])
+    client, calls = _fake_client(
+      lambda _: pp.PagedResponse(
+        pages=[
+          pp.PageResult(page_index=3, patterns=[grid]),
+          pp.PageResult(page_index=1, patterns=[]),
+        ]
+      )
+    )
+    images = [
+      (9, b"a", "image/jpeg"),
+      (10, b"b", "image/jpeg"),
+      (11, b"c", "image/jpeg"),
+    ]
+    results = pp.send_batch_to_gemini(client, images, "m")
+    assert results == [[], [], [grid]]
+    assert calls[0]["contents"][0] == "PAGE_1"
+    assert calls[0]["contents"][4] == "PAGE_3"
+
+  def test_prompt_sent_as_system_instruction(self) -> None:
+    client, calls = _fake_client(
+      lambda kwargs: pp.PagedResponse(pages=[])
+      if len(kwargs["contents"]) > 1
+      else pp.PageResponse(patterns=[])
+    )
+    pp.send_batch_to_gemini(client, [(9, b"a", "image/jpeg")], "m")
+    pp.send_batch_to_gemini(
+      client, [(9, b"a", "image/jpeg"), (10, b"b", "image/jpeg")], "m"
+    )
+    for call in calls:
+      config = call["config"]
+      assert config.system_instruction == pp.EXTRACTION_PROMPT
+      assert pp.EXTRACTION_PROMPT not in call["contents"]
+    assert len(calls[0]["contents"]) == 1
+    assert calls[1]["contents"][-1] == pp.BATCH_PROMPT.format(count=2)
+
+
+class TestLooksLikeGridPage:
+  """Tests for looks_like_grid_page."""
+
+  @staticmethod
+  def _page(rows: list[int]) -> bytes:
+    img = Image.new("L", (1700, 2200), 255)
+    draw = ImageDraw.Draw(img)
+    for y in rows:
+      draw.line([(300, y), (1500, y)], fill=0, width=2)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+  def test_grid_detected(self) -> None:
+    rows = [300 + r * 32 for r in range(13)]
+    assert pp.looks_like_grid_page(self._page(rows))
+
+  def test_grid_with_merged_rows_detected(self) -> None:
+    # Rows 2 and 6 fully filled: their border lines disappear.
+    rows = [300 + r * 32 for r in range(13) if r not in (2, 3, 6, 7)]
+    assert pp.looks_like_grid_page(self._page(rows))
+
+  def test_reads_path(self, tmp_path: Path) -> None:
+    path = tmp_path / "page_009.png"
+    path.write_bytes(self._page([300 + r * 32 for r in range(13)]))
+    assert pp.looks_like_grid_page(path)
+
+  def test_blank_page_rejected(self) -> None:
+    assert not pp.looks_like_grid_page(self._page([]))
+
+  def test_staff_lines_rejected(self) -> None:
+    rows = [200 + s * 300 + n * 20 for s in range(6) for n in range(5)]
+    assert not pp.looks_like_grid_page(self._page(rows))
+
+  def test_golden_pages(self) -> None:
+    """Real rendered pages: no false negatives on grid pages."""
+    golden_dir = Path(__file__).resolve().parent / "golden"
+    for golden in sorted(golden_dir.glob("page_*.json")):
+      image = pp.IMAGES_DIR / golden.with_suffix(".png").name
+      if not image.exists():
+        pytest.skip(f"Image not available: {image}")
+      has_grids = bool(json.loads(golden.read_text())["patterns"])
+      assert pp.looks_like_grid_page(image) == has_grids, image.name
+
+
+class TestRoutePage:
+  """Tests for route_page."""
+
+  def test_fills_and_flushes_batches(self) -> None:
+    pages: queue.Queue[list[pp.PageImage] | None] = queue.Queue()
+    batch: list[pp.PageImage] = []
+    for n in (9, 10, 11):
+      batch = pp.route_page(
+        (n, b"", "image/jpeg"), _done(True), batch, pages, 2
+      )
+    assert [p[0] for p in pages.get_nowait()] == [9, 10]
+    assert [p[0] for p in batch] == [11]
+
+  def test_non_grid_page_skipped(
+    self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+  ) -> None:
+    monkeypatch.setattr(pp, "CONSENSUS_DIR", tmp_path)
+    pages: queue.Queue[list[pp.PageImage] | None] = queue.Queue()
+    batch = pp.route_page(
+      (9, b"", "image/jpeg"), _done(False), [], pages, 2
+    )
+    assert batch == []
+    assert pages.empty()
+    assert not (tmp_path / "page_009.json").exists()
+
+  def test_prefilter_error_sends_page(self) -> None:
+    failed: Future[bool] = Future()
+    failed.set_exception(OSError("cannot identify image file"))
+    pages: queue.Queue[list[pp.PageImage] | None] = queue.Queue()
+    batch = pp.route_page(
+      (9, b"", "image/jpeg"), failed, [], pages, 2
+    )
+    assert [p[0] for p in batch] == [9]
+
+  def test_cancelled_prefilter_sends_page(self) -> None:
+    cancelled: Future[bool] = Future()
+    cancelled.cancel()
+    pages: queue.Queue[list[pp.PageImage] | None] = queue.Queue()
+    batch = pp.route_page(
+      (9, b"", "image/jpeg"), cancelled, [], pages, 2
+    )
+    assert [p[0] for p in batch] == [9]
+
+
+class TestRenderWorker:
+  """Tests for render_worker."""
+
+  @pytest.fixture(autouse=True)
+  def _tmp_dirs(
+    self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+  ) -> None:
+    for name in ("IMAGES_DIR", "RENDER_CACHE_DIR", "CONSENSUS_DIR"):
+      monkeypatch.setattr(pp, name, tmp_path)
+
+  ARGS = argparse.Namespace(
+    force=False, dpi=200, format="jpeg", batch_size=4
+  )
+
+  def test_bad_image_skips_only_that_page(self, tmp_path: Path) -> None:
+    (tmp_path / "page_009.png").write_bytes(b"not a png")
+    (tmp_path / "page_010.png").write_bytes(_png(30, 30))
+    pages: queue.Queue[list[pp.PageImage] | None] = queue.Queue()
+    pp.render_worker(
+      None, "abc", range(9, 11), self.ARGS, pages, 1, None,
+      threading.Event(),
+    )
+    assert [p[0] for p in pages.get_nowait()] == [10]
+    assert pages.get_nowait() is None
+
+  def test_prefilter_gets_full_resolution_image(
+    self, tmp_path: Path
+  ) -> None:
+    (tmp_path / "page_009.png").write_bytes(_png(30, 30))
+    submitted = []
+
+    def submit(fn: object, image: Path) -> Future[bool]:
+      submitted.append(image)
+      return _done(True)
+
+    pages: queue.Queue[list[pp.PageImage] | None] = queue.Queue()
+    pp.render_worker(
+      None, "abc", range(9, 10), self.ARGS, pages, 1,
+      SimpleNamespace(submit=submit), threading.Event(),
+    )
+    assert submitted == [tmp_path / "page_009.png"]
+    assert [p[0] for p in pages.get_nowait()] == [9]